@@ -35,22 +35,74 @@ import os
 from datetime import datetime
 import openai
 from openai.embeddings_utils import distances_from_embeddings
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-    retry_if_exception_type
-)  # for exponential backoff
 import embed
+import embedders
+import ratelimit
 import config # set openai.api_key
 from textutils import clean_text
 
-# Turn the embeddings into a NumPy array, which will provide more flexibility
-df=pd.read_csv('processed/embeddings.csv', index_col=0)
-df['embeddings'] = df['embeddings'].apply(eval).apply(np.array)
+def load_index():
+    """
+    Load the index built by embed.create_embeddings() into a DataFrame.
+    The index metadata is kept in the DataFrame attributes.
+    """
+
+    # Make sure queries are embedded by the same provider that built the index
+    index_metadata = embedders.check_index_metadata(embedders.get_embedder())
+
+    # Turn the embeddings into a NumPy array, which will provide more flexibility
+    df=pd.read_csv(embedders.INDEX_FILE, index_col=0)
+    # Indexes built before chunk provenance was recorded cannot be filtered or cited
+    missing_columns = [column for column in embed.PROVENANCE_COLUMNS if column not in df.columns]
+    if missing_columns:
+        raise ValueError(
+            f"The index has no {', '.join(missing_columns)} column, it was built by an older version. "
+            "Rebuild the embeddings."
+        )
+    df['embeddings'] = df['embeddings'].apply(eval).apply(np.array)
+    if len(df):
+        embedders.check_dimension(df['embeddings'].iloc[0], index_metadata)
+    df['ingested_at'] = pd.to_datetime(df['ingested_at'])
+    df.attrs['metadata'] = index_metadata
+    return df
+
+def reload_index():
+    """
+    Load the index into the module-level df. If the index is missing or cannot
+    be used, df is left empty and index_error explains why, so that the app
+    keeps running and the embeddings can be rebuilt.
+    """
+    global df, index_error
+    try:
+        df = load_index()
+        index_error = None
+    except (OSError, ValueError) as e:
+        df = pd.DataFrame(columns=embed.PROVENANCE_COLUMNS + ['text', 'n_tokens', 'embeddings'])
+        index_error = str(e)
+
+reload_index()
 #print(df.head())
 
-def get_context_texts(question, df, max_len=1800):
+def filter_chunks(df, files=None, since=None, until=None):
+    """
+    Return the rows of the dataframe that match the given metadata filters.
+    
+    :param df: The DataFrame containing the texts and their provenance.
+    :param files: Only keep chunks from these source files (all files if empty or None).
+    :param since: Only keep chunks ingested at or after this date.
+    :param until: Only keep chunks ingested at or before this date.
+    :return: The filtered DataFrame.
+    """
+    mask = pd.Series(True, index=df.index)
+    if files:
+        mask &= df['filename'].isin(files)
+    if since:
+        mask &= df['ingested_at'] >= pd.Timestamp(since)
+    if until:
+        mask &= df['ingested_at'] <= pd.Timestamp(until)
+    return df[mask]
+
+def get_context_texts(question, df, max_len=1800, files=None, since=None, until=None):
     """
     Given a question, return the most similar context texts from the dataframe along with
     their distances from the question.
@@ -58,24 +110,33 @@ def get_context_texts(question, df, max_len=1800):
     :param question: The input question as a string.
     :param df: The DataFrame containing the texts and their embeddings.
     :param max_len: The maximum length of the combined context texts.
-    :return: A list of tuples where each tuple contains a context text and its distance from the question.
+    :param files: Only search chunks from these source files.
+    :param since: Only search chunks ingested at or after this date.
+    :param until: Only search chunks ingested at or before this date.
+    :return: A list of tuples where each tuple contains a context text, its distance from the question,
+             the index of its chunk in the dataframe and its source file.
     """
 
-    # Step 1: Compute embeddings for the input question
-    q_embeddings = openai.Embedding.create(
-            input=question, engine='text-embedding-ada-002'
-        )['data'][0]['embedding']
+    # Step 1: Apply the metadata filters, so that only the matching chunks are scored
+    candidates = filter_chunks(df, files=files, since=since, until=until)
+    if candidates.empty:
+        return []
+
+    # Step 2: Compute embeddings for the input question
+    q_embeddings = embedders.get_embedder().embed_one(question)
+    embedders.check_dimension(q_embeddings, df.attrs['metadata'])
 
-    # Step 2: Compute the distances between question embeddings and context text embeddings
-    df['distances'] = distances_from_embeddings(
-        q_embeddings, df['embeddings'].values, distance_metric='cosine')
+    # Step 3: Compute the distances between question embeddings and context text embeddings
+    distances = pd.Series(distances_from_embeddings(
+        q_embeddings, candidates['embeddings'].values, distance_metric='cosine'), index=candidates.index)
 
-    # Step 3: Initialize an empty list to store the selected context texts and their distances
+    # Step 4: Initialize an empty list to store the selected context texts and their distances
     context_texts_with_distances = []
     current_length = 0
 
-    # Step 4: Iterate over the texts sorted by their distances in ascending order
-    for index, row in df.sort_values('distances', ascending=True).iterrows():
+    # Step 5: Iterate over the texts sorted by their distances in ascending order
+    for index, distance in distances.sort_values(ascending=True).items():
+        row = candidates.loc[index]
 
         # Update the current length including a buffer for extra characters
         current_length += row['n_tokens'] + 4
@@ -84,15 +145,14 @@ def get_context_texts(question, df, max_len=1800):
         if current_length > max_len:
             break
 
-        # Add the text and its distance to the list
+        # Add the text, its distance, its chunk index and its source file to the list
         text = row["text"]
-        distance = row["distances"]
-        context_texts_with_distances.append((text, distance))
+        context_texts_with_distances.append((text, distance, index, row["filename"]))
 
     # Return the list of context texts along with their distances
     return context_texts_with_distances
 
-def answer_question(df, model="gpt-3.5-turbo", question="Di cosa parla il testo?", max_len=1800, max_tokens=200, debug=False):
+def answer_question(df, model="gpt-3.5-turbo", question="Di cosa parla il testo?", max_len=1800, max_tokens=200, files=None, since=None, until=None, debug=False):
     """
     Answer a question based on the most similar context from the dataframe texts.
     
@@ -101,28 +161,35 @@ def answer_question(df, model="gpt-3.5-turbo", question="Di cosa parla il testo?
     :param question: The input question as a string.
     :param max_len: The maximum length of the combined context texts.
     :param max_tokens: The maximum number of tokens for the language model response.
+    :param files: Only use context from these source files.
+    :param since: Only use context ingested at or after this date.
+    :param until: Only use context ingested at or before this date.
     :param debug: Boolean to control debug prints.
     :return: The answer string and context texts with their distances.
+             On failure, a message for the user and no context texts.
     """
 
     # Step 1: Define system message instructing the model how to behave
     system_msg = "Rispondi alla domanda basandoti UNICAMENTE sul contesto sotto. Usa un linguaggio semplice e chiaro. Se non puoi dare una risposta basandoti sul contesto, rispondi \"Non so.\", NON usare la tua conoscenza personale."
     
-    # Step 2: Get the context texts related to the input question
-    context_texts_with_distances = get_context_texts(question, df, max_len=max_len)
-    # Extract only the texts from the (text, distance) tuples for context
-    context_texts = "\n\n###\n\n".join([text_and_dist[0] for text_and_dist in context_texts_with_distances])
+    # The question embedding and the answer both call the API: on failure,
+    # return a message for the user instead of raising
+    try:
+        # Step 2: Get the context texts related to the input question
+        context_texts_with_distances = get_context_texts(question, df, max_len=max_len, files=files, since=since, until=until)
+        # Extract only the texts from the (text, distance, index, filename) tuples for context
+        context_texts = "\n\n###\n\n".join([text_and_dist[0] for text_and_dist in context_texts_with_distances])
 
-    # Step 3 (Optional): Debug prints for token counts
-    if debug:
-        print("System message tokens: " + str(embed.get_n_tokens(system_msg)))
-        print("Context tokens: " + str(embed.get_n_tokens(context_texts)))
-        print("Question tokens: " + str(embed.get_n_tokens(question)))
+        # Step 3 (Optional): Debug prints for token counts
+        if debug:
+            print("System message tokens: " + str(embed.get_n_tokens(system_msg)))
+            print("Context tokens: " + str(embed.get_n_tokens(context_texts)))
+            print("Question tokens: " + str(embed.get_n_tokens(question)))
 
-    # Step 4: Generate the answer using the OpenAI API
-    try:
+        # Step 4: Generate the answer using the OpenAI API
         # Make a request to OpenAI API with the context and question
-        response = openai.ChatCompletion.create(
+        response = chat_completion_with_backoff(
+            priority=ratelimit.INTERACTIVE,
             model=model,
             messages=[
                 {"role": "system", "content": system_msg},
@@ -146,10 +213,15 @@ def answer_question(df, model="gpt-3.5-turbo", question="Di cosa parla il testo?
         # Return the answer along with context_texts_with_distances
         return answer, context_texts_with_distances
 
+    except openai.error.RateLimitError as e:
+        # Interactive calls give up quickly when the API is overloaded
+        print(e)
+        return "Il servizio è sovraccarico in questo momento, riprova tra poco.", []
+
     except Exception as e:
         # Handle exceptions and print error message
         print(e)
-        return ""
+        return "Si è verificato un errore durante la risposta, riprova tra poco.", []
 
 def summarize_text(text, model="gpt-3.5-turbo", max_tokens=1000, debug=False):
     system_msg = (
@@ -293,13 +365,14 @@ def summarize(df, model="gpt-3.5-turbo", max_tokens=1000, debug=False):
     return {"success": True, "summaries": summaries}    
 
 
-@retry(
-    retry=retry_if_exception_type((openai.error.APIError, openai.error.APIConnectionError, openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout)), 
-    wait=wait_random_exponential(multiplier=1, max=60), 
-    stop=stop_after_attempt(10)
-)
-def chat_completion_with_backoff(**kwargs):
-    return openai.ChatCompletion.create(**kwargs)
+# Retries follow the budget of the priority, see ratelimit.py
+def chat_completion_with_backoff(priority=ratelimit.BATCH, **kwargs):
+    return ratelimit.call_with_backoff(
+        kwargs['model'],
+        lambda: openai.ChatCompletion.create(**kwargs),
+        tokens=ratelimit.count_chat_tokens(kwargs['messages'], kwargs.get('max_tokens')),
+        priority=priority,
+    )
 
 
 
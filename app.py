@@ -1,9 +1,10 @@
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, request, render_template, redirect, url_for, flash, send_from_directory
 import os
 from flask import jsonify
 import config
 import embed  
 import answer  
+import textfiles
 
 app = Flask(__name__)
 
@@ -33,6 +34,10 @@ def index():
 @app.route('/summarize', methods=['POST'])
 def summarize():
     try:
+        # Without a usable index there is nothing to summarize
+        if answer.index_error:
+            return jsonify({"success": False, "error": answer.index_error}), 500
+
         # Use answer.py script to get a summary of the text
         result = answer.summarize(answer.df, debug=True)
         if result["success"]:
@@ -68,17 +73,32 @@ def query():
     Allow users to input a query and display the response.
     """
     context_texts = []
+    # Optional metadata filters: source files and ingestion date range
+    files = request.form.getlist('files')
+    since = request.form.get('since') or None
+    until = request.form.get('until') or None
     if request.method == 'POST':
         # When form is submitted, process the query
         question = request.form['question']
 
-        # Use answer.py script to get the response
-        response, context_texts = answer.answer_question(answer.df, question=question, max_len=3300, max_tokens=600, debug=True)
+        if answer.index_error:
+            # Without a usable index, show why instead of an answer
+            response = answer.index_error
+        else:
+            # Use answer.py script to get the response.
+            # The end date is inclusive, so search up to the end of that day
+            response, context_texts = answer.answer_question(answer.df, question=question, max_len=3300, max_tokens=600,
+                                                             files=files, since=since,
+                                                             until=until and f"{until} 23:59:59", debug=True)
 
         # Prepend the question and response to the conversation history to display it at the top
         conversation_history.insert(0, {'question': question, 'answer': response})
 
-    return render_template('query.html', conversation_history=conversation_history, context_texts=context_texts)
+    # Source files available in the index, for the filters
+    indexed_files = sorted(answer.df['filename'].unique())
+    return render_template('query.html', conversation_history=conversation_history, context_texts=context_texts,
+                           indexed_files=indexed_files, selected_files=files, since=since, until=until,
+                           index_error=answer.index_error)
 
 @app.route('/clear_conversation', methods=['POST'])
 def clear_conversation():
@@ -90,18 +110,38 @@ def clear_conversation():
 
 @app.route('/files')
 def list_files():
-    # Ottieni la lista dei file nella cartella 'text'
-    files = os.listdir('text')
+    # Ottieni la lista dei file caricati, con dimensione e numero di chunk
+    chunk_counts = answer.df['filename'].value_counts()
+    files = [dict(file, chunks=int(chunk_counts.get(file['name'], 0)))
+             for file in textfiles.list_files(config.UPLOAD_FOLDER)]
     # Renderizza il template, passando la lista dei file
     return render_template('file_list.html', file_list=files)
 
 @app.route('/view_file/<filename>')
 def view_file(filename):
-    # Leggi il contenuto del file
-    with open(os.path.join('text', filename), 'r') as file:
-        content = file.read()
-    # Renderizza il template, passando il nome del file e il suo contenuto
-    return render_template('view_file.html', filename=filename, content=content)
+    file_path = os.path.join(config.UPLOAD_FOLDER, filename)
+    page = request.args.get('page', 1, type=int)
+
+    # Se è richiesto un chunk, evidenzialo usando i suoi offset nel file
+    chunk = request.args.get('chunk', type=int)
+    highlight = None
+    if chunk is not None and chunk in answer.df.index and answer.df.loc[chunk, 'filename'] == filename:
+        highlight = (int(answer.df.loc[chunk, 'byte_start']), int(answer.df.loc[chunk, 'byte_end']))
+        # Se non è indicata una pagina, vai a quella che contiene il chunk
+        if 'page' not in request.args:
+            page = textfiles.page_of_offset(file_path, highlight[0])
+
+    # Leggi solo la pagina richiesta del file
+    content = textfiles.read_page(file_path, page, highlight=highlight)
+    # Renderizza il template, passando il nome del file e la pagina
+    return render_template('view_file.html', filename=filename, chunk=chunk, **content)
+
+@app.route('/raw_file/<filename>')
+def raw_file(filename):
+    # Invia il file così com'è; le richieste con header Range
+    # ricevono solo l'intervallo di byte richiesto.
+    # La cartella è risolta rispetto alla directory corrente, come nelle altre route
+    return send_from_directory(os.path.abspath(config.UPLOAD_FOLDER), filename, mimetype='text/plain', conditional=True)
 
 @app.route('/delete_file/<filename>', methods=['GET'])
 def delete_file(filename):
@@ -113,6 +153,7 @@ def delete_file(filename):
         # Prova a eliminare il file
         try:
             os.remove(file_path)
+            textfiles.invalidate_listing(config.UPLOAD_FOLDER)
             # Messaggio di successo (opzionale)
             flash('File eliminato con successo.', 'success')
         except:
@@ -144,6 +185,7 @@ def upload_file():
         if file:
             filename = file.filename
             file.save(os.path.join(config.UPLOAD_FOLDER, filename))
+            textfiles.invalidate_listing(config.UPLOAD_FOLDER)
             flash('File caricato con successo!', 'success')
             return redirect(url_for('list_files'))
 
@@ -158,6 +200,10 @@ def create_embeddings():
     try:
         # Lancia la funzione per creare gli embedding
         embed.create_embeddings()
+        # Ricarica l'indice, in modo che domande e lista dei file lo usino subito
+        answer.reload_index()
+        if answer.index_error:
+            return jsonify({'status': 'error', 'message': answer.index_error}), 500
         # Ritorna un successo
         return jsonify({'status': 'success'}), 200
     except Exception as e:
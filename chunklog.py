@@ -0,0 +1,98 @@
+"""
+Write-ahead log of the embeddings computed during an ingestion.
+
+Every embedded batch is appended to the log, and flushed to disk, as soon as
+it is computed. If the ingestion stops before the index is written, the next
+run reads back the embeddings already in the log and only embeds the chunks
+that are missing. The log is removed once the index has been written.
+
+The log is a JSON lines file. The first line describes the embedder that
+computed the embeddings; every other line is a committed batch with the hashes
+of the chunk texts and their embeddings. A line cut short by a crash is
+discarded.
+"""
+import os
+import json
+import hashlib
+
+def chunk_key(text):
+    """
+    Return the key identifying a chunk text in the log.
+    """
+    return hashlib.sha256(text.encode("UTF-8")).hexdigest()
+
+class ChunkLog:
+    """
+    Append-only log of the embeddings computed by one embedder.
+    """
+
+    def __init__(self, path, embedder):
+        self.path = path
+        self.header = {'provider': embedder.name, 'model': embedder.model}
+        self.file = None
+
+    def _read(self):
+        """
+        Return the embeddings committed to the log, by chunk key, and the
+        position of the end of the last complete line.
+        """
+        committed = {}
+        end = 0
+        with open(self.path, 'rb') as file:
+            for n, line in enumerate(file):
+                # A line without newline was being written when the ingestion stopped
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if n == 0:
+                    # The embeddings were computed by another embedder, they cannot be reused
+                    if record != self.header:
+                        return {}, 0
+                else:
+                    committed.update(zip(record['keys'], record['embeddings']))
+                end += len(line)
+        return committed, end
+
+    def open(self):
+        """
+        Open the log for appending and return the embeddings already committed
+        to it, by chunk key.
+        """
+        committed, end = {}, 0
+        if os.path.exists(self.path):
+            committed, end = self._read()
+
+        self.file = open(self.path, 'ab')
+        # Drop any incomplete line, so that new batches start on a line of their own
+        self.file.truncate(end)
+        if end == 0:
+            self._write(self.header)
+        return committed
+
+    def _write(self, record):
+        self.file.write(json.dumps(record).encode("UTF-8") + b'\n')
+        self.file.flush()
+        # The batch is committed only once it is on disk
+        os.fsync(self.file.fileno())
+
+    def append(self, keys, embeddings):
+        """
+        Commit a batch of embeddings to the log.
+        """
+        self._write({'keys': keys, 'embeddings': embeddings})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        """
+        Close and delete the log, once its content is in the index.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -8,6 +8,58 @@ UPLOAD_FOLDER = 'text/'
 # Maximum number of tokens of each text chunk that gets embedded
 MAX_TOKENS = 500 
 
+# Embedding provider used both to build the index and to embed queries:
+#  - 'openai': OpenAI Embeddings API (network round trip, billed per token)
+#  - 'local':  sentence-transformers model run in-process on the CPU
+EMBEDDING_PROVIDER = 'openai'
+
+# Model used by the 'openai' embedding provider
+OPENAI_EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+# Model used by the 'local' embedding provider
+LOCAL_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+# Number of texts embedded in a single request / inference batch
+EMBEDDING_BATCH_SIZE = 64
+
+# Number of chunks embedded between two writes to the ingestion log.
+# A failed ingestion resumes from the last batch written
+INGESTION_LOG_BATCH_SIZE = 512
+
+# Write-ahead log of the embeddings computed by an ingestion in progress
+INGESTION_LOG = 'processed/embeddings.log'
+
+# Number of worker threads used by the 'local' embedding provider.
+# A single worker already uses every core through torch's own threads
+EMBEDDING_WORKERS = 1
+
+# OpenAI rate limits of the account, per model: (requests per minute, tokens per minute).
+# They are the upper bound of the adaptive limits used by ratelimit.py
+OPENAI_RATE_LIMITS = {
+    'text-embedding-ada-002': (3000, 1000000),
+    'gpt-3.5-turbo': (3500, 90000),
+    'default': (3000, 90000),
+}
+
+# Share of the rate limits that batch jobs (ingestion, summarization)
+# leave free for interactive queries
+INTERACTIVE_RESERVE = 0.2
+
+# Retries of failed OpenAI calls: (maximum attempts, maximum wait in seconds between them).
+# Interactive queries give up quickly instead of holding a web request for minutes
+INTERACTIVE_RETRY_POLICY = (3, 4)
+BATCH_RETRY_POLICY = (10, 60)
+
+# Maximum number of lines shown in each page of the file viewer
+VIEWER_LINES_PER_PAGE = 500
+
+# Maximum number of bytes shown in each page of the file viewer,
+# so that very long lines are split across pages
+VIEWER_MAX_PAGE_BYTES = 256 * 1024
+
+# Number of files whose line offsets are kept in memory by the file viewer
+VIEWER_CACHED_FILES = 16
+
 # Load environment variables from .env file
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -32,33 +32,34 @@ SOFTWARE.
 import os
 import pandas as pd
 from datetime import datetime
-import openai
 import tiktoken
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-    retry_if_exception_type
-)  # for exponential backoff
 import config # set openai.api_key
-from textutils import clean_text, split_into_sentences
+import embedders
+import chunklog
+from textutils import clean_text_with_offsets, split_into_sentence_spans
 
 # Load the cl100k_base tokenizer which is designed to work with the ada-002 model
 tokenizer = tiktoken.get_encoding("cl100k_base")
 
+# Columns recording where each chunk of the index comes from
+PROVENANCE_COLUMNS = ['title', 'filename', 'char_start', 'char_end', 'byte_start', 'byte_end', 'ingested_at']
+
 def get_n_tokens(text):
     """
     Return the number of tokens of a given text.
     """
     return len(tokenizer.encode(text))
 
-def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
+def split_into_many_with_spans(text, max_tokens=config.MAX_TOKENS, debug=False):
     """
     Split the text into chunks of a maximum number of tokens.
+    Return a list of (chunk, start, end) tuples, where start and end are the
+    character positions in the text of the sentences that make up the chunk.
     """
 
     # Split the text into sentences
-    sentences = split_into_sentences(text)
+    sentence_spans = split_into_sentence_spans(text)
+    sentences = [sentence for sentence, start, end in sentence_spans]
 
     # Get the number of tokens for each sentence
     n_tokens = [len(tokenizer.encode(" " + sentence)) for sentence in sentences]
@@ -66,16 +67,17 @@ def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
     chunks = []
     tokens_so_far = 0
     chunk = []
+    chunk_start = chunk_end = 0
 
     # Loop through the sentences and tokens joined together in a tuple
-    for sentence, tokens in zip(sentences, n_tokens):
+    for (sentence, start, end), tokens in zip(sentence_spans, n_tokens):
 
         # If the number of tokens so far plus the number of tokens in the
         # current sentence is greater than the max number of tokens, then 
         # add the chunk to the list of chunks and reset the chunk 
         # and tokens so far
         if tokens_so_far + tokens > max_tokens:
-            chunks.append(". ".join(chunk) + ".")
+            chunks.append((". ".join(chunk) + ".", chunk_start, chunk_end))
             chunk = []
             tokens_so_far = 0
 
@@ -88,7 +90,10 @@ def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
 
         # Otherwise, add the sentence to the chunk and add the number of 
         # tokens to the total
+        if not chunk:
+            chunk_start = start
         chunk.append(sentence)
+        chunk_end = end
         tokens_so_far += tokens
 
     if debug:
@@ -104,11 +109,17 @@ def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
             for sentence in sentences:
                 file.write(f"{sentence}\n")
             file.write("--CHUNKS--\n")
-            for chunk in chunks:
+            for chunk, start, end in chunks:
                 file.write(f"{chunk}\n")
 
     return chunks
 
+def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
+    """
+    Split the text into chunks of a maximum number of tokens.
+    """
+    return [chunk for chunk, start, end in split_into_many_with_spans(text, max_tokens, debug)]
+
 # def delayed_embedding(x, engine='text-embedding-ada-002', delay_in_seconds: float = 1):
 #     """
 #     Pace requests in order to avoid reaching the rate limit:
@@ -119,86 +130,135 @@ def split_into_many(text, max_tokens=config.MAX_TOKENS, debug=False):
 #     # Return embedding 
 #     return openai.Embedding.create(input=x, engine='text-embedding-ada-002')['data'][0]['embedding']
 
-@retry(
-    retry=retry_if_exception_type((openai.error.APIError, openai.error.APIConnectionError, openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout)), 
-    wait=wait_random_exponential(multiplier=1, max=60), 
-    stop=stop_after_attempt(10)
-)
-def embedding_with_backoff(text, engine='text-embedding-ada-002'):
-    return openai.Embedding.create(input=text, engine=engine)['data'][0]['embedding']
 
+def byte_offsets(text, char_offsets):
+    """
+    Convert character positions in the text into byte positions in its
+    UTF-8 encoding.
+    """
+    byte_offsets = {}
+    char_position = byte_position = 0
+    # Walk the text once, from the first position to the last
+    for char_offset in sorted(set(char_offsets)):
+        byte_position += len(text[char_position:char_offset].encode("UTF-8"))
+        char_position = char_offset
+        byte_offsets[char_offset] = byte_position
+    return [byte_offsets[char_offset] for char_offset in char_offsets]
+
+def previous_ingestion_times(path=embedders.INDEX_FILE):
+    """
+    Return the ingestion time of the chunks of the current index,
+    by source file and chunk key.
+    """
+    try:
+        previous = pd.read_csv(path, usecols=['filename', 'text', 'ingested_at'])
+    except (OSError, ValueError):
+        # No index yet, or one built before ingestion times were recorded
+        return {}
+    return {(file, chunklog.chunk_key(text)): ingested_at
+            for file, text, ingested_at in zip(previous.filename, previous.text, previous.ingested_at)}
+
+def split_file(file, text, ingested_at, ingestion_times=None):
+    """
+    Split the content of a text file into chunks and return a list of
+    dictionaries with the text of each chunk and its provenance: source file,
+    character and byte offsets in the file, ingestion time.
+    Chunks found in ingestion_times keep the time they were first ingested,
+    the others get ingested_at.
+    """
+    # Clean the text, remembering where every character comes from
+    cleansed_text, offsets = clean_text_with_offsets(text)
+
+    # If the number of tokens is greater than the max number of tokens
+    # split the text into chunks
+    if get_n_tokens(cleansed_text) > config.MAX_TOKENS:
+        spans = split_into_many_with_spans(cleansed_text, debug=True)
+    # Otherwise, the whole text is a single chunk
+    else:
+        spans = [(cleansed_text, 0, len(cleansed_text))]
+
+    # Skip empty chunks, which cannot be embedded
+    spans = [(chunk, start, end) for chunk, start, end in spans if chunk.strip()]
+
+    # Map the chunk boundaries in the cleaned text back to the original file
+    char_starts = [offsets[start] for chunk, start, end in spans]
+    char_ends = [offsets[end - 1] + 1 for chunk, start, end in spans]
+    byte_starts = byte_offsets(text, char_starts)
+    byte_ends = byte_offsets(text, char_ends)
+
+    ingestion_times = ingestion_times or {}
+    rows = []
+    for i, (chunk, start, end) in enumerate(spans):
+        rows.append({
+            # - and _ in text file name are replaced with spaces.
+            'title': file.replace('-',' ').replace('_', ' '),
+            'filename': file,
+            'char_start': char_starts[i],
+            'char_end': char_ends[i],
+            'byte_start': byte_starts[i],
+            'byte_end': byte_ends[i],
+            'ingested_at': ingestion_times.get((file, chunklog.chunk_key(chunk)), ingested_at),
+            'text': chunk,
+        })
+    return rows
 
 def create_embeddings():
     """
     Create embeddings for the content in the text files.
     """
 
-    # Create a list to store the text files
-    texts=[]
+    # Complete the write of an index interrupted by a previous run
+    embedders.recover_index()
+
+    # Time of this ingestion, recorded on the chunks that are new or changed.
+    # The others keep the time recorded in the current index
+    ingested_at = datetime.now().isoformat(timespec='seconds')
+    ingestion_times = previous_ingestion_times()
+
+    # Create a list to store the chunks of all the text files
+    rows = []
     
     # Get all the text files in the text directory
-    for file in os.listdir(config.UPLOAD_FOLDER):
+    for file in sorted(os.listdir(config.UPLOAD_FOLDER)):
     
-        # Open the file and read the text
-        with open(config.UPLOAD_FOLDER + file, "r", encoding="UTF-8") as f:
+        # Open the file and read the text. newline='' keeps line endings
+        # as they are, so that offsets match the file on disk
+        with open(os.path.join(config.UPLOAD_FOLDER, file), "r", encoding="UTF-8", newline='') as f:
             text = f.read()
-            cleansed_text = clean_text(text)
 
-            # Add a tuple (file name, file text conent) to 'texts' list.
-            #  - and _ in text file name are replaced with spaces.
-            texts.append((file.replace('-',' ').replace('_', ' '), cleansed_text))
-    
-    # Create a dataframe from the list of texts
-    df = pd.DataFrame(texts, columns = ['filename', 'text'])
+        rows += split_file(file, text, ingested_at, ingestion_times)
     
     # Create a directory to store the csv files
     if not os.path.exists("processed"):
             os.mkdir("processed")
-    df.to_csv('processed/texts.csv')
-    #print(df.head())
-    
-    """
-    Record current length of each row 
-    to identify which rows need to be split
-    """
 
-    
-    df = pd.read_csv('processed/texts.csv', index_col=0)
-    df.columns = ['title', 'text']
-    
-    # Tokenize the text and save the number of tokens to a new column
+    df = pd.DataFrame(rows, columns=PROVENANCE_COLUMNS + ['text'])
     df['n_tokens'] = df.text.apply(lambda x: len(tokenizer.encode(x)))
-    
     #print(df.head()) 
     
-    """
-    Split longer lines into smaller chunks
-    """
-    shortened = []
-    
-    # Loop through the dataframe
-    for row in df.iterrows():
-    
-        # If the text is None, go to the next row
-        if row[1]['text'] is None:
-            continue
-        
-        # If the number of tokens is greater than the max number of tokens
-        # split the text into chunks
-        if row[1]['n_tokens'] > config.MAX_TOKENS:
-            shortened += split_into_many(row[1]['text'], debug=True)
-        
-        # Otherwise, add the text to the list of shortened texts
-        else:
-            shortened.append(row[1]['text'])
-    
-    df = pd.DataFrame(shortened, columns=['text'])
-    df['n_tokens'] = df.text.apply(lambda x: len(tokenizer.encode(x)))
-    #print(df.head()) 
-    
-    # Create embeddings, using the function delayed_embedding()
-    df['embeddings'] = df.text.apply(embedding_with_backoff)
-    df.to_csv('processed/embeddings.csv')
+    # Create embeddings in batches, using the configured embedding provider.
+    # Embeddings left in the log by a previous, interrupted run are reused
+    embedder = embedders.get_embedder()
+    log = chunklog.ChunkLog(config.INGESTION_LOG, embedder)
+    committed = log.open()
+    try:
+        keys = [chunklog.chunk_key(text) for text in df.text]
+        missing = list(dict.fromkeys(key for key in keys if key not in committed))
+        texts = dict(zip(keys, df.text))
+        for batch in embedders.batches(missing, config.INGESTION_LOG_BATCH_SIZE):
+            embeddings = embedder.embed([texts[key] for key in batch])
+            # Commit the batch to the log before going on with the next one
+            log.append(batch, embeddings)
+            committed.update(zip(batch, embeddings))
+    finally:
+        log.close()
+    df['embeddings'] = [committed[key] for key in keys]
+
+    # Write the index, recording which provider built it and the length of the vectors it returned
+    dimension = len(df['embeddings'].iloc[0]) if len(df) else None
+    embedders.write_index(df, embedder, dimension)
+    # All the embeddings are durably in the index now, the log is no longer needed
+    log.remove()
     #print(df.head()) 
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+"""
+Embedding providers.
+
+Every provider exposes the same interface:
+ - name:       identifier of the provider, as used in config.EMBEDDING_PROVIDER
+ - model:      name of the model that computes the embeddings
+ - embed(texts, priority):     return a list of embeddings, one per text
+ - embed_one(text, priority):  return the embedding of a single text
+
+The priority (ratelimit.INTERACTIVE or ratelimit.BATCH) only matters to
+providers that call a rate-limited API.
+
+The provider and model that built the index are recorded next to it, with the
+length of the vectors they actually returned, so that an index is never
+queried with embeddings from a different model.
+"""
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import openai
+import config # set openai.api_key
+import ratelimit
+
+# The index, and the file describing the embedder that built it
+INDEX_FILE = 'processed/embeddings.csv'
+INDEX_METADATA_FILE = 'processed/embeddings.json'
+
+def batches(items, batch_size):
+    """
+    Split a list into consecutive batches of at most batch_size items.
+    """
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+def embeddings_with_backoff(texts, engine, priority=ratelimit.BATCH):
+    response = ratelimit.call_with_backoff(
+        engine,
+        lambda: openai.Embedding.create(input=texts, engine=engine),
+        tokens=ratelimit.count_tokens(texts),
+        priority=priority,
+    )
+    # The API does not guarantee that the embeddings come back in input order
+    return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+
+class OpenAIEmbedder:
+    """
+    Compute embeddings with the OpenAI Embeddings API.
+    """
+    name = 'openai'
+
+    def __init__(self, model=config.OPENAI_EMBEDDING_MODEL, batch_size=config.EMBEDDING_BATCH_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+
+    def embed(self, texts, priority=ratelimit.BATCH):
+        embeddings = []
+        # Send several texts in each request to save round trips
+        for batch in batches(list(texts), self.batch_size):
+            embeddings += embeddings_with_backoff(batch, engine=self.model, priority=priority)
+        return embeddings
+
+    def embed_one(self, text, priority=ratelimit.INTERACTIVE):
+        return self.embed([text], priority=priority)[0]
+
+class LocalEmbedder:
+    """
+    Compute embeddings in-process on the CPU with a sentence-transformers model.
+    No network round trip and no per-token cost.
+    """
+    name = 'local'
+
+    def __init__(self, model=config.LOCAL_EMBEDDING_MODEL, batch_size=config.EMBEDDING_BATCH_SIZE, workers=config.EMBEDDING_WORKERS):
+        # sentence-transformers is only needed when the local provider is selected
+        from sentence_transformers import SentenceTransformer
+        import torch
+
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.encoder = SentenceTransformer(model, device='cpu')
+        if workers > 1:
+            # Every encode() call already uses torch's own pool of threads:
+            # share the cores among the workers instead of oversubscribing them
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+    def _encode(self, batch):
+        # Normalized vectors, so that cosine distances behave as with ada-002
+        vectors = self.encoder.encode(batch, batch_size=self.batch_size, normalize_embeddings=True)
+        return vectors.tolist()
+
+    def embed(self, texts, priority=ratelimit.BATCH):
+        texts = list(texts)
+        if len(texts) <= self.batch_size:
+            return self._encode(texts)
+
+        # With more than one worker, batches are encoded in parallel by a pool
+        # of threads sharing the same model, each with its share of the cores
+        embeddings = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch_embeddings in executor.map(self._encode, batches(texts, self.batch_size)):
+                embeddings += batch_embeddings
+        return embeddings
+
+    def embed_one(self, text, priority=ratelimit.INTERACTIVE):
+        return self._encode([text])[0]
+
+PROVIDERS = {
+    OpenAIEmbedder.name: OpenAIEmbedder,
+    LocalEmbedder.name: LocalEmbedder,
+}
+
+_embedder = None
+
+def get_embedder():
+    """
+    Return the embedding provider selected in config.EMBEDDING_PROVIDER.
+    The provider is created once and then reused.
+    """
+    global _embedder
+    if _embedder is None:
+        if config.EMBEDDING_PROVIDER not in PROVIDERS:
+            raise ValueError(f"Unknown embedding provider: {config.EMBEDDING_PROVIDER}")
+        _embedder = PROVIDERS[config.EMBEDDING_PROVIDER]()
+    return _embedder
+
+def _fsync_directory(path):
+    """
+    Flush to disk the entries of the directory containing path, e.g. after a rename.
+    """
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_index(df, embedder, dimension, path=INDEX_FILE, metadata_path=INDEX_METADATA_FILE):
+    """
+    Write the index, recording which embedder built it and the length of its vectors.
+
+    Both files are written to temporary files first and flushed to disk. Then
+    the index is replaced, and the metadata last: if the process stops in
+    between, recover_index() completes the replacement. When this function
+    returns, the new index is durable.
+    """
+    metadata = {'provider': embedder.name, 'model': embedder.model, 'dimension': dimension}
+    with open(path + '.tmp', 'w', newline='') as file:
+        df.to_csv(file)
+        file.flush()
+        os.fsync(file.fileno())
+    with open(metadata_path + '.tmp', 'w') as file:
+        json.dump(metadata, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    # Make the renames durable too
+    _fsync_directory(path)
+    _fsync_directory(metadata_path)
+
+def recover_index(path=INDEX_FILE, metadata_path=INDEX_METADATA_FILE):
+    """
+    Complete a write_index() that stopped after replacing the index but before
+    replacing its metadata.
+    """
+    # The temporary metadata is only written once the temporary index is
+    # complete: if the latter is gone, it already replaced the index
+    if os.path.exists(metadata_path + '.tmp') and not os.path.exists(path + '.tmp'):
+        os.replace(metadata_path + '.tmp', metadata_path)
+        _fsync_directory(metadata_path)
+
+def read_index_metadata(path=INDEX_METADATA_FILE):
+    """
+    Return the description of the embedder that built the index.
+    """
+    recover_index(metadata_path=path)
+    # Every index is written together with its metadata: without it, the
+    # embedder that built the index is unknown
+    if not os.path.exists(path):
+        raise ValueError(f"The index has no metadata file {path}. Rebuild the embeddings.")
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def check_index_metadata(embedder, path=INDEX_METADATA_FILE):
+    """
+    Raise an error if the index was built by a different embedder than the one
+    used for queries. Return the index metadata.
+    """
+    metadata = read_index_metadata(path)
+    if (metadata['provider'], metadata['model']) != (embedder.name, embedder.model):
+        raise ValueError(
+            f"The index was built with {metadata['provider']}/{metadata['model']}, "
+            f"but the configured embedder is {embedder.name}/{embedder.model}. "
+            "Rebuild the embeddings or change config.EMBEDDING_PROVIDER."
+        )
+    return metadata
+
+def check_dimension(embedding, metadata):
+    """
+    Raise an error if an embedding does not have the length recorded in the index metadata.
+    """
+    if len(embedding) != metadata['dimension']:
+        raise ValueError(
+            f"The index holds {metadata['dimension']}-dimensional embeddings, "
+            f"but the embedder returned {len(embedding)} dimensions. "
+            "Rebuild the embeddings or change config.EMBEDDING_PROVIDER."
+        )
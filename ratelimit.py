@@ -0,0 +1,222 @@
+"""
+Process-wide rate-limit scheduler for the OpenAI API.
+
+Every OpenAI call goes through a token bucket for requests per minute and
+tokens per minute, one per model since that is how OpenAI enforces its limits.
+Interactive calls (queries) take precedence over batch calls (ingestion,
+summarization): batch calls wait while an interactive call is waiting and
+cannot use the share of the bucket reserved for interactive traffic.
+
+The limits adapt to the API responses: a rate-limit error halves them and
+pauses the bucket, every successful call raises them a little, up to the
+configured maximum.
+
+Failed calls are retried with a budget that depends on the priority: a few
+short waits for interactive calls, a long exponential backoff for batch calls.
+"""
+import time
+import threading
+import openai
+import tiktoken
+from tenacity import (
+    Retrying,
+    stop_after_attempt,
+    wait_random_exponential,
+    retry_if_exception_type
+)  # for exponential backoff
+import config
+
+# Priorities, lower is served first
+INTERACTIVE = 0
+BATCH = 1
+
+# Retry policy of each priority: (maximum attempts, maximum wait in seconds)
+RETRY_POLICIES = {
+    INTERACTIVE: config.INTERACTIVE_RETRY_POLICY,
+    BATCH: config.BATCH_RETRY_POLICY,
+}
+
+# Transient errors retried with exponential backoff.
+# Rate-limit errors are retried by the scheduler, which also adapts the limits
+TRANSIENT_ERRORS = (openai.error.APIError, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.Timeout)
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(texts):
+    """
+    Return the number of tokens of a text or of a list of texts.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(tokenizer.encode(text)) for text in texts)
+
+def count_chat_tokens(messages, max_tokens=None):
+    """
+    Estimate the tokens a chat completion request counts against the limit:
+    the prompt plus the maximum length of the completion.
+    """
+    # Every message carries a few tokens of formatting on top of its content
+    prompt_tokens = sum(count_tokens(message['content']) + 4 for message in messages)
+    return prompt_tokens + (max_tokens or 0)
+
+def retry_after(error):
+    """
+    Return the number of seconds the API asked to wait, if any.
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class RateLimitScheduler:
+    """
+    Token buckets for the requests and the tokens per minute of one model.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, interactive_reserve=config.INTERACTIVE_RESERVE):
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.interactive_reserve = interactive_reserve
+
+        # Both buckets start full
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+
+        self.condition = threading.Condition()
+        self.waiting = {INTERACTIVE: 0, BATCH: 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.requests_per_minute,
+                                      self.available_requests + elapsed * self.requests_per_minute / 60)
+        self.available_tokens = min(self.tokens_per_minute,
+                                    self.available_tokens + elapsed * self.tokens_per_minute / 60)
+        return now
+
+    def _wait_time(self, now, requests_needed, tokens_needed):
+        """
+        Return how long to wait before the buckets hold what is needed.
+        """
+        return max(
+            self.paused_until - now,
+            (requests_needed - self.available_requests) * 60 / self.requests_per_minute,
+            (tokens_needed - self.available_tokens) * 60 / self.tokens_per_minute,
+            0.01,
+        )
+
+    def acquire(self, tokens, priority=BATCH, timeout=None):
+        """
+        Block until a request of the given number of tokens can be sent.
+        Raise a rate-limit error if that would take longer than timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = self._refill()
+
+                    # A request larger than the whole bucket would wait forever
+                    tokens_needed = min(tokens, self.tokens_per_minute)
+                    requests_needed = 1
+                    if priority == BATCH:
+                        # Leave room for the interactive traffic
+                        tokens_needed = min(tokens_needed + self.interactive_reserve * self.tokens_per_minute,
+                                            self.tokens_per_minute)
+                        requests_needed = min(1 + self.interactive_reserve * self.requests_per_minute,
+                                              self.requests_per_minute)
+
+                    blocked = priority == BATCH and self.waiting[INTERACTIVE] > 0
+                    if (not blocked and now >= self.paused_until
+                            and self.available_requests >= requests_needed
+                            and self.available_tokens >= tokens_needed):
+                        self.available_requests -= 1
+                        self.available_tokens -= min(tokens, self.tokens_per_minute)
+                        return
+
+                    wait = self._wait_time(now, requests_needed, tokens_needed)
+                    if deadline is not None and now + wait > deadline:
+                        raise openai.error.RateLimitError(f"Rate limit: the request could not be sent within {timeout} seconds")
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def on_success(self):
+        """
+        Slowly raise the limits back towards the configured maximum.
+        """
+        with self.condition:
+            self.requests_per_minute = min(self.max_requests_per_minute,
+                                           self.requests_per_minute + self.max_requests_per_minute * 0.05)
+            self.tokens_per_minute = min(self.max_tokens_per_minute,
+                                         self.tokens_per_minute + self.max_tokens_per_minute * 0.05)
+
+    def on_rate_limit(self, wait=None):
+        """
+        Halve the limits, empty the buckets and pause all the callers.
+        """
+        with self.condition:
+            self.requests_per_minute = max(1, self.requests_per_minute / 2)
+            self.tokens_per_minute = max(1000, self.tokens_per_minute / 2)
+            self.available_requests = 0.0
+            self.available_tokens = 0.0
+            if wait is None:
+                # Time for the halved request bucket to let one request through
+                wait = 60 / self.requests_per_minute
+            self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            self.condition.notify_all()
+
+    def call(self, fn, tokens, priority=BATCH, max_attempts=10, max_wait=None):
+        """
+        Call fn once the limits allow it, retrying on rate-limit errors.
+        Wait at most max_wait seconds for the limits, if given.
+        """
+        for attempt in range(max_attempts):
+            self.acquire(tokens, priority, timeout=max_wait)
+            try:
+                result = fn()
+            except openai.error.RateLimitError as e:
+                self.on_rate_limit(retry_after(e))
+                if attempt == max_attempts - 1:
+                    raise
+                continue
+            self.on_success()
+            return result
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(model):
+    """
+    Return the scheduler shared by all the calls to the given model.
+    """
+    with _schedulers_lock:
+        if model not in _schedulers:
+            requests_per_minute, tokens_per_minute = config.OPENAI_RATE_LIMITS.get(
+                model, config.OPENAI_RATE_LIMITS['default'])
+            _schedulers[model] = RateLimitScheduler(requests_per_minute, tokens_per_minute)
+        return _schedulers[model]
+
+def call_with_backoff(model, fn, tokens, priority=BATCH):
+    """
+    Call fn through the scheduler of the given model, retrying transient errors
+    and rate-limit errors within the retry budget of the priority.
+    """
+    attempts, max_wait = RETRY_POLICIES[priority]
+    retrying = Retrying(
+        retry=retry_if_exception_type(TRANSIENT_ERRORS),
+        wait=wait_random_exponential(multiplier=1, max=max_wait),
+        stop=stop_after_attempt(attempts)
+    )
+    # Interactive calls do not queue behind the limits for longer than their wait cap
+    scheduler_wait = max_wait if priority == INTERACTIVE else None
+    return retrying(get_scheduler(model).call, fn, tokens=tokens, priority=priority,
+                    max_attempts=attempts, max_wait=scheduler_wait)
@@ -0,0 +1,180 @@
+"""
+Access to the uploaded text files that does not scale with their size.
+
+Files are read through memory maps, one page at a time. A page holds a
+bounded number of lines and of bytes, so that a file made of a single huge
+line is paged too. The byte offset of every page is computed once per file
+and cached until the file changes. The listing of the upload folder is cached
+until the folder changes.
+"""
+import os
+import mmap
+import threading
+from collections import OrderedDict
+import numpy as np
+import config
+
+# Size of the blocks scanned for newlines when indexing a file
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+_page_offsets_cache = OrderedDict()
+_listing_cache = {}
+_lock = threading.Lock()
+
+def _scan_line_offsets(path, size):
+    """
+    Return a NumPy array with the byte offset of the start of every line of the file.
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    if size > 0:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for block_start in range(0, size, SCAN_BLOCK_SIZE):
+                block = np.frombuffer(mm, dtype=np.uint8, offset=block_start,
+                                      count=min(SCAN_BLOCK_SIZE, size - block_start))
+                # Every newline starts a new line right after it
+                offsets.append(np.flatnonzero(block == ord('\n')).astype(np.int64) + block_start + 1)
+                # Release the view on the map, or it cannot be closed
+                del block
+    offsets = np.concatenate(offsets)
+    # A newline at the very end of the file does not start a new line
+    if len(offsets) > 1 and offsets[-1] == size:
+        offsets = offsets[:-1]
+    return offsets
+
+def _utf8_boundary(mm, position, start):
+    """
+    Move a position back to the start of a UTF-8 character, but not before start.
+    """
+    # Continuation bytes of a UTF-8 character look like 0b10xxxxxx
+    while position > start + 1 and mm[position] & 0xC0 == 0x80:
+        position -= 1
+    return position
+
+def _scan_page_offsets(path, size, lines_per_page, max_page_bytes):
+    """
+    Return a NumPy array with the byte offset of the start of every page of the file.
+    A page holds at most lines_per_page lines and at most max_page_bytes bytes:
+    it ends at a line start when possible, otherwise, inside a line longer than
+    the limit, at the start of a UTF-8 character.
+    """
+    lines = _scan_line_offsets(path, size)
+    pages = [0]
+    if size == 0:
+        return np.array(pages, dtype=np.int64)
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while True:
+            # The page starts inside line number first_line (the start may be in the middle of a line)
+            first_line = int(np.searchsorted(lines, start, side='right')) - 1
+            end = int(lines[first_line + lines_per_page]) if first_line + lines_per_page < len(lines) else size
+            if end - start > max_page_bytes:
+                limit = start + max_page_bytes
+                # Last line start within the limit, if there is one after the start of the page
+                last_line = int(lines[np.searchsorted(lines, limit, side='right') - 1])
+                end = last_line if last_line > start else _utf8_boundary(mm, limit, start)
+            if end >= size:
+                break
+            pages.append(end)
+            start = end
+    return np.array(pages, dtype=np.int64)
+
+def page_offsets(path, lines_per_page=config.VIEWER_LINES_PER_PAGE, max_page_bytes=config.VIEWER_MAX_PAGE_BYTES):
+    """
+    Return the size of the file and the byte offsets of its pages,
+    from the cache if the file has not changed since they were computed.
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size, lines_per_page, max_page_bytes)
+    with _lock:
+        cached = _page_offsets_cache.get(path)
+        if cached is not None and cached[0] == key:
+            _page_offsets_cache.move_to_end(path)
+            return stat.st_size, cached[1]
+
+    offsets = _scan_page_offsets(path, stat.st_size, lines_per_page, max_page_bytes)
+
+    with _lock:
+        _page_offsets_cache[path] = (key, offsets)
+        _page_offsets_cache.move_to_end(path)
+        # Forget the least recently viewed files
+        while len(_page_offsets_cache) > config.VIEWER_CACHED_FILES:
+            _page_offsets_cache.popitem(last=False)
+    return stat.st_size, offsets
+
+def _decode(mm, start, end):
+    """
+    Return the text between two byte offsets of a mapped file.
+    """
+    return mm[start:end].decode('UTF-8', errors='replace')
+
+def page_of_offset(path, byte_offset, lines_per_page=config.VIEWER_LINES_PER_PAGE, max_page_bytes=config.VIEWER_MAX_PAGE_BYTES):
+    """
+    Return the number (starting from 1) of the page containing the given byte offset.
+    """
+    size, offsets = page_offsets(path, lines_per_page, max_page_bytes)
+    return max(int(np.searchsorted(offsets, byte_offset, side='right')), 1)
+
+def read_page(path, page, lines_per_page=config.VIEWER_LINES_PER_PAGE, max_page_bytes=config.VIEWER_MAX_PAGE_BYTES, highlight=None):
+    """
+    Read a page of the file.
+
+    :param path: The path of the file.
+    :param page: The number of the page, starting from 1.
+    :param lines_per_page: The maximum number of lines in each page.
+    :param max_page_bytes: The maximum number of bytes in each page.
+    :param highlight: Optional (start, end) byte offsets of a part of the file to highlight.
+    :return: A dictionary with the page number, the number of pages and the text of the page,
+             split into the parts before, inside and after the highlighted range.
+    """
+    size, offsets = page_offsets(path, lines_per_page, max_page_bytes)
+    n_pages = len(offsets)
+    page = min(max(page, 1), n_pages)
+
+    start = int(offsets[page - 1])
+    end = int(offsets[page]) if page < n_pages else size
+
+    # Split the page around the part of the highlighted range that falls in it
+    cited_start = cited_end = end
+    if highlight is not None and highlight[0] < end and highlight[1] > start:
+        cited_start = max(start, highlight[0])
+        cited_end = min(end, highlight[1])
+
+    content = {'page': page, 'n_pages': n_pages, 'before': '', 'cited': '', 'after': ''}
+    if end > start:
+        # Map the file once and slice the three parts of the page from it
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content['before'] = _decode(mm, start, cited_start)
+            content['cited'] = _decode(mm, cited_start, cited_end)
+            content['after'] = _decode(mm, cited_end, end)
+    return content
+
+def list_files(folder=config.UPLOAD_FOLDER):
+    """
+    Return the name and size of the files in the folder, sorted by name,
+    from the cache if the folder has not changed since they were listed.
+    """
+    key = os.stat(folder).st_mtime_ns
+    with _lock:
+        cached = _listing_cache.get(folder)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    files = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                files.append({'name': entry.name, 'size': entry.stat().st_size})
+    files.sort(key=lambda file: file['name'])
+
+    with _lock:
+        _listing_cache[folder] = (key, files)
+    return files
+
+def invalidate_listing(folder=config.UPLOAD_FOLDER):
+    """
+    Forget the cached listing of the folder, e.g. after a file was overwritten,
+    which does not always change the modification time of the folder.
+    """
+    with _lock:
+        _listing_cache.pop(folder, None)
@@ -1,41 +1,108 @@
 import re
+from array import array
+from bisect import bisect_right
 import spacy
 
+# Steps of the text cleaning, as (pattern, replacement) pairs
+CLEANING_STEPS = [
+    # Replace multiple newlines (and whitespaces around or within them) with a single newline
+    (r'\s*\n\s*', '\n'),
+    # Replace dash followed by a newline with an empty string
+    (r'-\n', ''),
+    # Replace remaining newlines with a space
+    (r'\n', ' '),
+    # Replace multiple spaces with a single space
+    (r' {2,}', ' '),
+]
+
+class OffsetMap:
+    """
+    Map positions in a cleaned text back to positions in the original text.
+
+    Only the places where a cleaning step changed the length of the text are
+    stored, as breakpoints (position after the step, position before the step);
+    between two breakpoints positions move together.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def add_step(self, new_positions, old_positions):
+        self.steps.append((new_positions, old_positions))
+
+    def __getitem__(self, position):
+        # Undo the cleaning steps from the last to the first
+        for new_positions, old_positions in reversed(self.steps):
+            i = bisect_right(new_positions, position) - 1
+            if i >= 0:
+                position = old_positions[i] + (position - new_positions[i])
+        return position
+
+def _sub_with_offsets(pattern, repl, text):
+    """
+    Apply re.sub(pattern, repl, text) and return the result with the
+    breakpoints of the positions changed by the substitution.
+    """
+    new_positions = array('q')
+    old_positions = array('q')
+    shift = 0
+
+    def replace(match):
+        nonlocal shift
+        length = match.end() - match.start()
+        if length != len(repl):
+            # The replacement starts where the match started...
+            new_positions.append(match.start() + shift)
+            old_positions.append(match.start())
+            shift += len(repl) - length
+            # ...and the text after it follows the end of the match
+            new_positions.append(match.end() + shift)
+            old_positions.append(match.end())
+        return repl
+
+    return re.sub(pattern, replace, text), new_positions, old_positions
+
+def clean_text_with_offsets(text):
+    """
+    Remove blank lines from the text to declutter it, and also return an
+    OffsetMap giving, for every character of the cleaned text, its position
+    in the input text.
+    """
+    offsets = OffsetMap()
+    for pattern, repl in CLEANING_STEPS:
+        text, new_positions, old_positions = _sub_with_offsets(pattern, repl, text)
+        offsets.add_step(new_positions, old_positions)
+    return text, offsets
+
 def clean_text(text):
     """
     Remove blank lines from the input series to declutter the text files
     and make them easier to process.
     """
-    
-    # Replace multiple newlines (and whitespaces around or within them) with a single newline
-    text = re.sub(r'\s*\n\s*', '\n', text)
-    
-    # Replace dash followed by a newline with an empty string
-    text = re.sub(r'-\n', '', text)
-    
-    # Replace remaining newlines with a space
-    text = text.replace('\n', ' ')
-    
-    # Ensure that every full stop is followed by a blank
-    #text = text.replace('.', '. ')
-
-    # Replace multiple spaces with a single space
-    text = re.sub(r' +', ' ', text)
-    
+    for pattern, repl in CLEANING_STEPS:
+        text = re.sub(pattern, repl, text)
     return text
 
-def split_into_sentences(text):
+def split_into_sentence_spans(text):
+    """
+    Split the text into sentences and return a list of
+    (sentence, start, end) tuples, with the character positions of each
+    sentence in the text.
+    """
     # Carica il modello di lingua. 'it_core_news_sm' è per l'italiano.
     # Carica il modello di lingua. 'en_core_web_sm' è per l'inglese.
     nlp = spacy.load('en_core_web_sm')
 
     # Processa il testo con spaCy
     doc = nlp(text)
-    
-    # Estrai le frasi dal documento processato
-    sentences = [sent.text for sent in doc.sents]
-    
-    return sentences
+
+    return [(sent.text, sent.start_char, sent.end_char) for sent in doc.sents]
+
+def split_into_sentences(text):
+    """
+    Split the text into sentences.
+    """
+    return [sentence for sentence, start, end in split_into_sentence_spans(text)]
 
 if __name__ == "__main__":
     # # Leggi il file di testo